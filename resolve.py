@@ -3,18 +3,32 @@ resolve3.py: a recursive resolver built using dnspython
 """
 
 import argparse
+import asyncio
+import collections
+import copy
+import sys
+import time
 
+import dns.asyncquery
+import dns.entropy
+import dns.exception
+import dns.flags
 import dns.message
 import dns.name
 import dns.query
+import dns.rcode
 import dns.rdata
 import dns.rdataclass
+import dns.rrset
+from cachetools import TTLCache
 from dns import rdatatype
 
-FORMATS = (("CNAME", "{alias} is an alias for {name}"),
-           ("A", "{name} has address {address}"),
-           ("AAAA", "{name} has IPv6 address {address}"),
-           ("MX", "{name} mail is handled by {preference} {exchange}"))
+# Bound format methods for each type of output line, called with the fields
+# as positional arguments so that no dict is built per record
+FORMATS = {"CNAME": "{0} is an alias for {1}\n".format,
+           "A": "{0} has address {1}\n".format,
+           "AAAA": "{0} has IPv6 address {1}\n".format,
+           "MX": "{0} mail is handled by {1} {2}\n".format}
 
 # current as of 19 October 2020
 ROOT_SERVERS = ("198.41.0.4",
@@ -31,223 +45,1181 @@ ROOT_SERVERS = ("198.41.0.4",
                 "199.7.83.42",
                 "202.12.27.33")
 
+# Zones whose name servers a long-lived resolver can look up in advance, so
+# lookups under them can skip asking the root servers
+PRIME_ZONES = ("com.", "net.", "org.", "de.", "uk.", "cn.", "ru.", "nl.",
+               "br.", "au.", "fr.", "it.", "jp.", "in.", "pl.", "ca.",
+               "io.", "info.", "edu.", "gov.")
 
-def collect_results(name: str) -> dict:
+# How many servers each query is sent to at once. The first usable reply wins
+# and the others are cancelled, so one slow server can't stall a lookup.
+# Kept small to limit the amount of extra traffic sent.
+QUERY_FANOUT = 2
+
+# Query timeouts are worked out per server from a moving average of its
+# round trip times, clamped between the minimum and maximum. Servers that
+# haven't answered yet get the default.
+DEFAULT_TIMEOUT = 2.0
+MIN_TIMEOUT = 0.25
+MAX_TIMEOUT = 5.0
+TIMEOUT_RTT_MULTIPLIER = 5
+RTT_SMOOTHING = 0.125
+
+# How long a pooled UDP socket to a server is kept open without being used
+UDP_IDLE_TIMEOUT = 60
+# Pooled sockets are replaced after this many queries or seconds. A new
+# socket gets a new random source port, so a server's queries don't all come
+# from one port that leaves only the query id for a forged reply to guess.
+UDP_SOCKET_MAX_QUERIES = 100
+UDP_SOCKET_LIFETIME = 10
+
+
+def iter_results(name: str, responses: list):
     """
-    This function parses final answers into the proper data structure that
-    print_results requires. The main work is done within the `lookup` function.
+    Yields the lines of output for the responses from collect_results, like
+    the host program would print them.
     """
-    full_response = {}
-    target_name = dns.name.from_text(name)
-    # lookup CNAME
-    response = lookup(target_name, rdatatype.CNAME)
-    cnames = []
-    for answers in response.answer:
+    cname_response, a_response, aaaa_response, mx_response = responses
+    # CNAME
+    fmt = FORMATS["CNAME"]
+    for answers in cname_response.answer:
         for answer in answers:
-            cnames.append({"name": answer, "alias": name})
-    # lookup A
-    response = lookup(target_name, rdatatype.A)
-    arecords = []
-    for answers in response.answer:
+            yield fmt(name, answer)
+    # A
+    fmt = FORMATS["A"]
+    for answers in a_response.answer:
+        if answers.rdtype != rdatatype.A:
+            continue
         a_name = answers.name
         for answer in answers:
-            if answer.rdtype == 1:  # A record
-                arecords.append({"name": a_name, "address": str(answer)})
-    # lookup AAAA
-    response = lookup(target_name, rdatatype.AAAA)
-    aaaarecords = []
-    for answers in response.answer:
+            yield fmt(a_name, answer)
+    # AAAA
+    fmt = FORMATS["AAAA"]
+    for answers in aaaa_response.answer:
+        if answers.rdtype != rdatatype.AAAA:
+            continue
         aaaa_name = answers.name
         for answer in answers:
-            if answer.rdtype == 28:  # AAAA record
-                aaaarecords.append({"name": aaaa_name, "address": str(answer)})
-    # lookup MX
-    response = lookup(target_name, rdatatype.MX)
-    mxrecords = []
-    for answers in response.answer:
+            yield fmt(aaaa_name, answer)
+    # MX
+    fmt = FORMATS["MX"]
+    for answers in mx_response.answer:
+        if answers.rdtype != rdatatype.MX:
+            continue
         mx_name = answers.name
         for answer in answers:
-            if answer.rdtype == 15:  # MX record
-                mxrecords.append({"name": mx_name,
-                                  "preference": answer.preference,
-                                  "exchange": str(answer.exchange)})
+            yield fmt(mx_name, answer.preference, answer.exchange)
+
+
+# Cache sizes and lifetimes. Entries are also dropped once their own record
+# TTL runs out, CACHE_TTL only caps how long anything is kept.
+CACHE_SIZE = 10_000
+CACHE_TTL = 3600
+NEGATIVE_TTL = 60
+# How long past its TTL an answer may still be served while it is refreshed
+# in the background (RFC 8767)
+STALE_TTL = 86400
+
+
+def get_reply_answer(reply: dns.message.Message, name: dns.name.Name,
+                     rdtype: rdatatype):
+    """
+    Returns the rrset of the given type for a name from the answer section
+    of a reply, following any aliases the reply also answers for, or None if
+    the reply doesn't contain one
+
+    reply: The reply to search
+    name: The name being looked up
+    rdtype: The type of record being looked up
+    """
+    # Each alias followed uses up an rrset, which stops alias loops
+    for _ in range(len(reply.answer)):
+        cname_rrset = None
+        for answer_rr in reply.answer:
+            if answer_rr.name == name:
+                if answer_rr.rdtype == rdtype:
+                    return answer_rr
+                if answer_rr.rdtype == rdatatype.CNAME:
+                    cname_rrset = answer_rr
+        if cname_rrset is None:
+            return None
+        name = cname_rrset[0].target
+    return None
+
 
-    full_response["CNAME"] = cnames
-    full_response["A"] = arecords
-    full_response["AAAA"] = aaaarecords
-    full_response["MX"] = mxrecords
+class UdpPoolProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram protocol for one pooled server socket. Hands each reply to the
+    future waiting on its transaction id.
+    """
 
-    return full_response
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+        self.opened_at = time.monotonic()
+        # Number of queries sent through this socket
+        self.queries = 0
+        # Whether the pool has replaced this socket and will close it once
+        # the queries still waiting on it finish
+        self.retired = False
 
+    def connection_made(self, transport) -> None:
+        self.transport = transport
 
-answer_cache = {}
-authority_cache = {}
-active_lookups = set()
+    def datagram_received(self, data: bytes, addr) -> None:
+        if len(data) < 2:
+            return
+        future = self.pending.pop(int.from_bytes(data[:2], "big"), None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+    def error_received(self, exc: Exception) -> None:
+        # Unreachable servers are handled like ones that never answer, the
+        # waiting queries time out and are retried over TCP
+        pass
 
 
-def load_initial_servers_to_query(target_name: dns.name.Name):
+class UdpPool:
     """
-    This function finds any intermediate NS Authority caches for the given name
-    and return the list of results ordered from least significant
-    to most significant
+    Keeps one UDP socket open per server and sends every query to that
+    server through it, telling the replies apart by transaction id.
+    Each socket is replaced by a new one after UDP_SOCKET_MAX_QUERIES
+    queries or UDP_SOCKET_LIFETIME seconds. Sockets that haven't been used
+    for UDP_IDLE_TIMEOUT seconds are closed, and all of them are closed when
+    the event loop shuts down.
     """
-    servers_to_query = []
-    # Search for caches of intermediate namespaces
-    for i in reversed(range(len(target_name.labels) - 2)):
-        domain = target_name.labels[i + 1:]
-        if domain in authority_cache:
-            for server in authority_cache[domain]:
+
+    def __init__(self):
+        self.loop = None
+        # server -> (transport, protocol, last used)
+        self.endpoints = {}
+        # server -> task opening a socket to it, shared by every query
+        # waiting for that socket
+        self.opening = {}
+        # Protocols of replaced sockets still waiting on replies
+        self.retired = set()
+        # Task closing the sockets when the event loop shuts down
+        self.shutdown_task = None
+        self.last_sweep = time.monotonic()
+
+    async def get_endpoint(self, server: str) -> tuple:
+        """
+        Returns the transport and protocol for a server, opening a socket
+        to it if there isn't one open yet
+
+        server: The server to get a socket for
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # Sockets can't be shared between event loops
+            if self.loop is not None and not self.loop.is_closed():
+                self.close()
+            self.loop = loop
+            self.endpoints = {}
+            self.opening = {}
+            self.retired = set()
+            self.shutdown_task = loop.create_task(self.close_on_shutdown())
+        now = time.monotonic()
+        if now - self.last_sweep > UDP_IDLE_TIMEOUT:
+            self.close_idle(now)
+        if server in self.endpoints:
+            transport, protocol, _ = self.endpoints[server]
+            if (protocol.queries < UDP_SOCKET_MAX_QUERIES
+                    and now - protocol.opened_at < UDP_SOCKET_LIFETIME):
+                self.endpoints[server] = (transport, protocol, now)
+                return transport, protocol
+            # Move the server on to a new socket and source port
+            del self.endpoints[server]
+            self.retire(protocol)
+        if server not in self.opening:
+            self.opening[server] = loop.create_task(
+                self.open_endpoint(server)
+            )
+        # Shielded so that a cancelled query doesn't stop the socket being
+        # opened for the others waiting on it
+        return await asyncio.shield(self.opening[server])
+
+    async def open_endpoint(self, server: str) -> tuple:
+        """
+        Opens a socket to a server and adds it to the pool
+
+        server: The server to open a socket to
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            transport, protocol = await loop.create_datagram_endpoint(
+                UdpPoolProtocol, remote_addr=(server, 53)
+            )
+        finally:
+            if self.opening.get(server) is asyncio.current_task():
+                del self.opening[server]
+        if loop is self.loop:
+            self.endpoints[server] = (transport, protocol, time.monotonic())
+        else:
+            # The pool has moved on to another event loop since
+            transport.close()
+        return transport, protocol
+
+    async def close_on_shutdown(self) -> None:
+        """
+        Waits until cancelled, which asyncio.run does to every task when it
+        shuts the event loop down, then closes all of the sockets while the
+        loop can still close them
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_future()
+        finally:
+            # Unless the pool has moved on to another loop, which closed
+            # these sockets already
+            if loop is self.loop:
+                self.close()
+
+    def retire(self, protocol: UdpPoolProtocol) -> None:
+        """
+        Closes a socket that has been taken out of the pool, or marks it to
+        be closed once the queries still waiting on it finish
+
+        protocol: The protocol of the socket
+        """
+        if protocol.pending:
+            protocol.retired = True
+            self.retired.add(protocol)
+        else:
+            protocol.transport.close()
+
+    def close(self) -> None:
+        """
+        Closes all of the sockets in the pool
+        """
+        for transport, _, _ in self.endpoints.values():
+            transport.close()
+        for protocol in self.retired:
+            protocol.transport.close()
+        self.endpoints = {}
+        self.retired = set()
+
+    def close_idle(self, now: float) -> None:
+        """
+        Closes the sockets that haven't been used for UDP_IDLE_TIMEOUT
+        seconds
+
+        now: The current time
+        """
+        self.last_sweep = now
+        for server, (transport, protocol, last_used) in \
+                list(self.endpoints.items()):
+            if now - last_used > UDP_IDLE_TIMEOUT and not protocol.pending:
+                transport.close()
+                del self.endpoints[server]
+
+    async def query(self, outbound_query: dns.message.QueryMessage,
+                    server: str, timeout: float) -> dns.message.Message:
+        """
+        Sends a DNS query to a server over its pooled socket and returns the
+        response. Raises the same exceptions as dns.asyncquery.udp.
+
+        outbound_query: The DNS query to execute
+        server: The server to query for an answer
+        timeout: How long to wait for the answer in seconds
+        """
+        transport, protocol = await self.get_endpoint(server)
+        if outbound_query.id in protocol.pending:
+            # Another query to this server is using the same id
+            return await dns.asyncquery.udp(outbound_query, server, timeout)
+        future = asyncio.get_running_loop().create_future()
+        protocol.pending[outbound_query.id] = future
+        protocol.queries += 1
+        try:
+            transport.sendto(outbound_query.to_wire())
+            wire = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=timeout)
+        finally:
+            if protocol.pending.get(outbound_query.id) is future:
+                del protocol.pending[outbound_query.id]
+            if protocol.retired and not protocol.pending:
+                protocol.transport.close()
+                self.retired.discard(protocol)
+        response = dns.message.from_wire(wire)
+        if not outbound_query.is_response(response):
+            raise dns.query.BadResponse
+        return response
+
+
+class PendingLookup:
+    """
+    One lookup in `do_lookup`'s stack of pending lookups, along with the
+    servers still to try for it
+    """
+
+    def __init__(self, resolver, target_name: dns.name.Name,
+                 qtype: rdatatype, serve_stale: bool, parent=None):
+        self.resolver = resolver
+        self.serve_stale = serve_stale
+        # The lookup waiting on this one for a server address, if any
+        self.parent = parent
+        # Key this lookup is registered under in the resolver's in-flight
+        # lookups, if it is
+        self.inflight_key = None
+        self.start(target_name, qtype)
+
+    def start(self, target_name: dns.name.Name, qtype: rdatatype) -> None:
+        """
+        Starts (or restarts, when following an alias) resolving a name from
+        the closest cached authority
+        """
+        self.target_name = target_name
+        self.qtype = qtype
+        self.labels = target_name.labels
+        self.outbound_query = dns.message.make_query(target_name, qtype)
+        self.servers_to_query = \
+            self.resolver.load_initial_servers_to_query(target_name)
+        self.queried_servers = set()
+        # The next servers to query, sent to all at once
+        self.servers = []
+        # Servers whose queries were cancelled because another server
+        # replied first
+        self.cut_off = []
+        # Where each zone's servers start in servers_to_query, one entry per
+        # referral followed. Queries are only sent to servers of the same
+        # zone at once, so a reply from a server further up can't cut off a
+        # closer one.
+        self.levels = []
+        # Whether an authoritative server replied without an answer
+        self.authoritative = False
+
+    def level_start(self) -> int:
+        """
+        Returns where the servers of the zone currently being asked start in
+        servers_to_query
+        """
+        return self.levels[-1] if len(self.levels) > 0 else 0
+
+    def add_server(self, server: str) -> None:
+        """
+        Adds a server address to the next batch to query unless it has
+        already been queried or couldn't be resolved
+        """
+        if server != "" and server not in self.queried_servers:
+            self.queried_servers.add(server)
+            self.servers.append(server)
+
+    async def query_servers(self):
+        """
+        Sends the query to the next batch of servers and returns the reply
+        used, or None if no server gave a usable one
+        """
+        queued = len(self.servers_to_query)
+        reply, unanswered = await self.resolver.do_dns_query(
+            self.target_name, self.outbound_query, self.servers,
+            self.servers_to_query
+        )
+        self.servers = []
+        self.cut_off += unanswered
+        if reply is not None and (reply.flags & dns.flags.AA
+                                  or reply.rcode() == dns.rcode.NXDOMAIN):
+            self.authoritative = True
+        if len(self.servers_to_query) > queued:
+            self.levels.append(queued)
+        return reply
+
+    def cached_response(self):
+        """
+        Returns a response built from the cache if the answer is cached,
+        otherwise None. Stale answers are refreshed in the background.
+        """
+        cached = self.resolver.get_cached_answer(self.labels, self.qtype)
+        if cached is None and self.serve_stale:
+            cached = self.resolver.get_stale_answer(self.labels, self.qtype)
+            if cached is not None:
+                self.resolver.schedule_refresh(self.target_name, self.qtype)
+        if cached is None:
+            return None
+        response = dns.message.make_response(self.outbound_query)
+        if len(cached) > 0:
+            response.answer = [cached]
+        return response
+
+    def unresolved_response(self) -> dns.message.Message:
+        """
+        Caches the fact that this lookup doesn't resolve to anything and
+        returns an empty response for it
+        """
+        self.resolver.negative_cache[(self.labels, self.qtype)] = True
+        response = dns.message.make_response(self.outbound_query)
+        if self.authoritative:
+            # Mark the empty reply as an authoritative NXDOMAIN or NODATA
+            # rather than a failure to reach any server
+            response.flags |= dns.flags.AA
+        return response
+
+
+class Resolver:
+    """
+    A recursive resolver along with its caches and what it has learned about
+    the servers it has queried. Each Resolver keeps its own state, so
+    separate instances don't share caches.
+
+    query_fanout: How many servers each query is sent to at once
+    prime: Whether to look up the name servers of PRIME_ZONES in the
+        background as soon as the resolver starts. That only pays off for
+        resolvers that go on to make many lookups.
+    """
+
+    def __init__(self, query_fanout: int = QUERY_FANOUT,
+                 prime: bool = False):
+        self.query_fanout = query_fanout
+        # (labels, rdtype) -> (expire_at, rrset)
+        self.answer_cache = TTLCache(maxsize=CACHE_SIZE,
+                                     ttl=CACHE_TTL + STALE_TTL)
+        # (labels, rdtype) -> True for lookups that didn't resolve to anything
+        self.negative_cache = TTLCache(maxsize=CACHE_SIZE, ttl=NEGATIVE_TTL)
+        # labels -> (expire_at, {ns names})
+        self.authority_cache = TTLCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+        # Background refreshes of stale answers, keyed by (labels, rdtype)
+        self.refresh_tasks = {}
+        # Lookups currently being resolved, so that concurrent callers asking
+        # for the same answer wait for it instead of repeating the queries.
+        # (labels, rdtype, serve_stale) -> (future, owning task)
+        self.inflight_lookups = {}
+        # task -> key of the in-flight lookup that task is waiting on
+        self.waiting_on = {}
+        # server -> whether it answered a query with several questions
+        # properly
+        self.multi_question_support = {}
+        # Multi-question queries finding out whether a server supports them,
+        # keyed by server
+        self.probe_tasks = {}
+        # server -> (average round trip time, number of samples)
+        self.server_stats = {}
+        self.udp_pool = UdpPool()
+        self.prime_task = None
+        # Priming needs a running event loop, without one it waits until
+        # start_priming is called from inside one
+        if prime:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                pass
+            else:
+                self.start_priming()
+
+    async def prime(self) -> None:
+        """
+        Looks up the name servers of each zone in PRIME_ZONES, filling the
+        authority cache and the addresses of those name servers.
+        Priming is only an optimisation, so a zone that fails to resolve is
+        left to be looked up normally.
+        """
+        await asyncio.gather(*(self.lookup(dns.name.from_text(zone),
+                                           rdatatype.NS)
+                               for zone in PRIME_ZONES),
+                             return_exceptions=True)
+
+    def start_priming(self) -> None:
+        """
+        Starts priming the caches in the background unless that has already
+        been started
+        """
+        if self.prime_task is None:
+            self.prime_task = asyncio.create_task(self.prime())
+
+    async def collect_results(self, name: str) -> list:
+        """
+        This function looks up the CNAME, A, AAAA and MX records for a name and
+        returns the responses in that order, ready for iter_results. The main
+        work is done within the `lookup` function.
+        """
+        target_name = dns.name.from_text(name)
+        return await self.lookup_types(target_name,
+                                       (rdatatype.CNAME, rdatatype.A,
+                                        rdatatype.AAAA, rdatatype.MX))
+
+    def cache_answer(self, labels: tuple, rrset: dns.rrset.RRset) -> None:
+        """
+        Caches an rrset under the given name until its TTL runs out
+
+        labels: The labels of the name the rrset answers for
+        rrset: The rrset to cache
+        """
+        key = (labels, rrset.rdtype)
+        self.answer_cache[key] = (
+            time.monotonic() + min(rrset.ttl, CACHE_TTL), rrset
+        )
+        self.negative_cache.pop(key, None)
+
+    def get_cached_answer(self, labels: tuple, rdtype: rdatatype):
+        """
+        Returns the cached rrset for the given name and type, an empty list if
+        the lookup is known not to resolve, or None if nothing is cached
+
+        labels: The labels of the name being looked up
+        rdtype: The type of record being looked up
+        """
+        key = (labels, rdtype)
+        entry = self.answer_cache.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        if key in self.negative_cache:
+            return []
+        return None
+
+    def get_stale_answer(self, labels: tuple, rdtype: rdatatype):
+        """
+        Returns the cached rrset for the given name and type if it has expired
+        but is still within STALE_TTL of its expiry, otherwise None
+
+        labels: The labels of the name being looked up
+        rdtype: The type of record being looked up
+        """
+        entry = self.answer_cache.get((labels, rdtype))
+        if entry is not None:
+            expire_at = entry[0]
+            if expire_at <= time.monotonic() < expire_at + STALE_TTL:
+                return entry[1]
+        return None
+
+    def get_cached_authorities(self, labels: tuple) -> set:
+        """
+        Returns the cached NS names for the given zone, or an empty set if
+        nothing is cached
+
+        labels: The labels of the zone
+        """
+        entry = self.authority_cache.get(labels)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+        return set()
+
+    def load_initial_servers_to_query(self, target_name: dns.name.Name):
+        """
+        This function finds any intermediate NS Authority caches for the given
+        name and return the list of results ordered from least significant
+        to most significant
+        """
+        servers_to_query = []
+        labels = target_name.labels
+        suffixes = [labels[i + 1:] for i in reversed(range(len(labels) - 2))]
+        # Search for caches of intermediate namespaces
+        for domain in suffixes:
+            for server in self.get_cached_authorities(domain):
                 servers_to_query.append((rdatatype.CNAME, server))
-        if domain in answer_cache:
-            if rdatatype.A in answer_cache[domain].keys():
+            a_rrset = self.get_cached_answer(domain, rdatatype.A)
+            cname_rrset = self.get_cached_answer(domain, rdatatype.CNAME)
+            if a_rrset:
+                servers_to_query.append((rdatatype.A, str(a_rrset[0])))
+            elif cname_rrset:
                 servers_to_query.append(
-                    (rdatatype.A, answer_cache[domain][rdatatype.A])
+                    (rdatatype.CNAME, cname_rrset[0].target)
                 )
-            elif rdatatype.CNAME in answer_cache[domain].keys():
-                servers_to_query.append(
-                    (rdatatype.CNAME, answer_cache[domain][rdatatype.CNAME])
+        if len(servers_to_query) == 0:
+            for server in ROOT_SERVERS:
+                servers_to_query.append((rdatatype.A, server))
+        return servers_to_query
+
+    def query_timeout(self, server: str) -> float:
+        """
+        Returns how long to wait for an answer from a server based on how
+        quickly it has answered before
+
+        server: The server about to be queried
+        """
+        if server not in self.server_stats:
+            return DEFAULT_TIMEOUT
+        average_rtt = self.server_stats[server][0]
+        return min(max(TIMEOUT_RTT_MULTIPLIER * average_rtt, MIN_TIMEOUT),
+                   MAX_TIMEOUT)
+
+    def record_rtt(self, server: str, rtt: float) -> None:
+        """
+        Folds a measured round trip time into a server's moving average
+
+        server: The server that answered
+        rtt: How long the server took to answer in seconds
+        """
+        if server not in self.server_stats:
+            self.server_stats[server] = (rtt, 1)
+        else:
+            average_rtt, count = self.server_stats[server]
+            self.server_stats[server] = (
+                (1 - RTT_SMOOTHING) * average_rtt + RTT_SMOOTHING * rtt,
+                count + 1
+            )
+
+    async def query_server(self, outbound_query: dns.message.QueryMessage,
+                           server: str, tcp_on_timeout: bool = True):
+        """
+        Sends a DNS query to a single server and returns the response, or None
+        if the server timed out, refused or failed the query, or sent back
+        something unusable.
+        Truncated or timed out UDP queries are retried once over TCP.
+
+        outbound_query: The DNS query to execute
+        server: The server to query for an answer
+        tcp_on_timeout: Whether to retry over TCP if the UDP query times out
+        """
+        # Every query sent gets its own random id, even when the same query
+        # goes to several servers
+        outbound_query = copy.copy(outbound_query)
+        outbound_query.id = dns.entropy.random_16()
+        try:
+            start = time.monotonic()
+            response = await self.udp_pool.query(
+                outbound_query, server, self.query_timeout(server)
+            )
+            self.record_rtt(server, time.monotonic() - start)
+        except dns.exception.Timeout:
+            if not tcp_on_timeout:
+                return None
+            return await self.query_server_tcp(outbound_query, server)
+        except dns.exception.DNSException:
+            return None
+        except ValueError:
+            return None
+        except OSError:
+            return None
+        if response.flags & dns.flags.TC:
+            return await self.query_server_tcp(outbound_query, server)
+        if response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            return None
+        return response
+
+    async def query_server_tcp(self, outbound_query: dns.message.QueryMessage,
+                               server: str):
+        """
+        Sends a DNS query to a single server over TCP and returns the response,
+        or None if the server timed out, refused the connection or the query,
+        or sent back something unusable
+
+        outbound_query: The DNS query to execute
+        server: The server to query for an answer
+        """
+        try:
+            start = time.monotonic()
+            response = await dns.asyncquery.tcp(outbound_query, server,
+                                                self.query_timeout(server))
+            self.record_rtt(server, time.monotonic() - start)
+        except dns.exception.DNSException:
+            return None
+        except ValueError:
+            return None
+        except OSError:
+            return None
+        if response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            return None
+        return response
+
+    async def query_first_response(self,
+                                   outbound_query: dns.message.QueryMessage,
+                                   servers: list):
+        """
+        Sends a DNS query to all of the given servers at once and returns the
+        first usable response, cancelling the queries still in flight, along
+        with the servers whose queries were cancelled.
+        The response is None if none of the servers gave a usable response.
+
+        outbound_query: The DNS query to execute
+        servers: The servers to query for an answer
+        """
+        pending = {
+            asyncio.create_task(self.query_server(outbound_query, server)):
+            server for server in servers
+        }
+        try:
+            while len(pending) > 0:
+                done, _ = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
                 )
-    if len(servers_to_query) == 0:
-        for server in ROOT_SERVERS:
-            servers_to_query.append((rdatatype.A, server))
-    return servers_to_query
+                for task in done:
+                    del pending[task]
+                    if task.result() is not None:
+                        return task.result(), list(pending.values())
+            return None, []
+        finally:
+            for task in pending:
+                task.cancel()
 
+    async def do_dns_query(self, target_name: dns.name.Name,
+                           outbound_query: dns.message.QueryMessage,
+                           servers: list,
+                           servers_to_query: list):
+        """
+        Executes a DNS query then caches the answers, authorities,
+        and additional info while adding any new authorities to the
+        servers_to_query list
 
-def do_dns_query(target_name: dns.name.Name,
-                 outbound_query: dns.message.QueryMessage,
-                 server: str,
-                 servers_to_query: list):
-    """
-    Executes a DNS query then caches the answers, authorities,
-    and additional info while adding any new authorities to the
-    servers_to_query list
-
-    target_name: The name of the target being queried for
-    outbound_qeury: The DNS query to execute
-    server: The server to query for an answer
-    servers_to_query: A list of servers in the format (rdtype, name)
-    """
-    try:
-        response = dns.query.udp(outbound_query, server, 3)
+        target_name: The name of the target being queried for
+        outbound_qeury: The DNS query to execute
+        servers: The servers to query for an answer, the first reply is used
+        servers_to_query: A list of servers in the format (rdtype, name)
+        Returns the reply used, or None if no server gave a usable one, and the
+        servers whose queries were cancelled once a reply was used
+        """
+        response, unanswered = await self.query_first_response(
+            outbound_query, servers
+        )
+        if response is not None:
+            self.cache_response(target_name, response, servers_to_query)
+        return response, unanswered
 
+    def cache_response(self, target_name: dns.name.Name,
+                       response: dns.message.Message,
+                       servers_to_query: list) -> None:
+        """
+        Caches the answers, authorities, and additional info from a response
+        while adding any new authorities to the servers_to_query list
+
+        target_name: The name of the target being queried for
+        response: The response to cache
+        servers_to_query: A list of servers in the format (rdtype, name)
+        """
         # Map answers from answer to answer_cache
-        if target_name.labels not in answer_cache:
-            answer_cache[target_name.labels] = {}
         for answer_rr in response.answer:
-            answer_cache[target_name.labels][answer_rr.rdtype] = answer_rr
+            self.cache_answer(target_name.labels, answer_rr)
         # Map answers from additional to answer_cache
         for server_rr in response.additional:
-            if server_rr.name.labels not in answer_cache:
-                answer_cache[server_rr.name.labels] = {}
-            answer_cache[server_rr.name.labels][server_rr.rdtype] = server_rr
+            self.cache_answer(server_rr.name.labels, server_rr)
         # Map NS records from authority to authority_cache
         # Record authorities as next servers to query
         for ns_record in response.authority:
             if ns_record.rdtype == rdatatype.NS and len(ns_record) > 0:
-                authority_cache[ns_record.name.labels] = []
+                # Add to any NS names already cached for the zone rather than
+                # replacing them, other servers may have returned other names
+                zone = ns_record.name.labels
+                now = time.monotonic()
+                expire_at = now + min(ns_record.ttl, CACHE_TTL)
+                authorities = {authority_name.target
+                               for authority_name in ns_record}
+                entry = self.authority_cache.get(zone)
+                if entry is not None and entry[0] > now:
+                    authorities |= entry[1]
+                    expire_at = max(expire_at, entry[0])
+                self.authority_cache[zone] = (expire_at, authorities)
                 for authority_name in ns_record:
-                    authority_cache[ns_record.name.labels].append(
-                        authority_name.target
-                    )
                     servers_to_query.append(
                         (rdatatype.CNAME, authority_name.target)
                     )
-    except dns.exception.Timeout:
-        pass
-    except ValueError:
-        pass
 
+    def get_cached_authority_address(self, target_name: dns.name.Name):
+        """
+        Returns the address of a cached authority for the closest zone
+        enclosing the given name, or None if no authority address is cached
 
-def resolve_dns_cname(server: dns.name.Name) -> str:
-    """
-    Takes a server name and resolves it to it's A record or returns ""
+        target_name: The name to find an authority for
+        """
+        labels = target_name.labels
+        for i in range(len(labels) - 1):
+            for server in self.get_cached_authorities(labels[i:]):
+                cached = self.get_cached_answer(server.labels, rdatatype.A)
+                if cached:
+                    return str(cached[0])
+        return None
 
-    server: the name of the server
-    """
-    # Don't query if looked up at a lower program depth
-    if server not in active_lookups:
-        if server in answer_cache and rdatatype.A in answer_cache[server]:
-            return answer_cache[server][rdatatype.A][0]
-
-        # Otherwise call a lookup for it
-        active_lookups.add(server)
-        server_ip = lookup(server, rdatatype.A)
-        active_lookups.discard(server)
-        if len(server_ip.answer) > 0:
-            return str(server_ip.answer[0][0])
-    return ""
-
-
-def lookup(target_name: dns.name.Name,
-           qtype: rdatatype) -> dns.message.Message:
-    """
-    This function uses a recursive resolver to find the relevant answer to the
-    query.
-    Parameters: target_name the hostname to get a DNS record for
-                qtype the type of DNS record that is being looked for
-    """
-    outbound_query = dns.message.make_query(target_name, qtype)
-    servers_to_query = load_initial_servers_to_query(target_name)
-    queried_servers = []
-
-    while len(servers_to_query) > 0:
-        # Check if an answer is cached
-        if target_name.labels in answer_cache:
-            if qtype in answer_cache[target_name.labels]:
-                response = dns.message.make_response(outbound_query)
-                if len(answer_cache[target_name.labels][qtype]) > 0:
-                    response.answer = [answer_cache[target_name.labels][qtype]]
-                return response
-            if (
-                rdatatype.CNAME in answer_cache[target_name.labels].keys()
-                and len(answer_cache[target_name.labels][rdatatype.CNAME]) > 0
-            ):
-                active_lookups.add(target_name)
-                res = lookup(
-                  answer_cache[target_name.labels][rdatatype.CNAME][0].target,
-                  qtype
+    async def do_multi_question_query(self, target_name: dns.name.Name,
+                                      qtypes: list,
+                                      server: str) -> None:
+        """
+        Asks a server for several record types of one name in a single query
+        and caches the answers it contains. Most servers don't support more
+        than one question per query, so whether this server did is remembered
+        in self.multi_question_support. Some only answer the first question,
+        so a missing answer doesn't mean there is no such record.
+        A server that doesn't answer at all is taken not to support it rather
+        than retried over TCP.
+
+        target_name: The name of the target being queried for
+        qtypes: The types of record being looked for
+        server: The server to query, normally the authority for target_name
+        """
+        outbound_query = dns.message.make_query(target_name, qtypes[0])
+        outbound_query.question = [
+            dns.rrset.RRset(target_name, dns.rdataclass.IN, qtype)
+            for qtype in qtypes
+        ]
+        response = await self.query_server(outbound_query, server,
+                                           tcp_on_timeout=False)
+        supported = (response is not None
+                     and len(response.question) == len(qtypes))
+        self.multi_question_support[server] = supported
+        if not supported:
+            return
+
+        self.cache_response(target_name, response, [])
+
+    async def refresh_answer(self, target_name: dns.name.Name,
+                             qtype: rdatatype) -> None:
+        """
+        Re-resolves a stale answer. A successful lookup replaces the cached
+        answer. If an authoritative server says the record no longer exists
+        the stale answer is dropped, otherwise a failed lookup leaves it in
+        place to keep serving.
+
+        target_name: The name to refresh
+        qtype: The type of record to refresh
+        """
+        response = await self.lookup(target_name, qtype, serve_stale=False)
+        if len(response.answer) > 0:
+            return
+        key = (target_name.labels, qtype)
+        if response.flags & dns.flags.AA:
+            self.answer_cache.pop(key, None)
+        else:
+            self.negative_cache.pop(key, None)
+
+    def schedule_refresh(self, target_name: dns.name.Name,
+                         qtype: rdatatype) -> None:
+        """
+        Starts a background refresh of a stale answer unless one is already
+        running for it
+
+        target_name: The name to refresh
+        qtype: The type of record to refresh
+        """
+        key = (target_name.labels, qtype)
+        if key not in self.refresh_tasks:
+            task = asyncio.create_task(self.refresh_answer(target_name, qtype))
+            self.refresh_tasks[key] = task
+            task.add_done_callback(lambda _: self.refresh_tasks.pop(key, None))
+
+    def would_deadlock(self, key: tuple) -> bool:
+        """
+        Checks whether waiting on the in-flight lookup for key would make the
+        current task wait on itself, either directly or through a chain of
+        other tasks waiting on each other's lookups
+
+        key: The key of the in-flight lookup
+        """
+        current_task = asyncio.current_task()
+        while key in self.inflight_lookups:
+            owner = self.inflight_lookups[key][1]
+            if owner is current_task:
+                return True
+            key = self.waiting_on.get(owner)
+        return False
+
+    async def wait_for_lookup(self, key: tuple) -> dns.message.Message:
+        """
+        Waits for another task's in-flight lookup to finish and returns its
+        response
+
+        key: The key of the in-flight lookup
+        """
+        current_task = asyncio.current_task()
+        self.waiting_on[current_task] = key
+        try:
+            return await asyncio.shield(self.inflight_lookups[key][0])
+        finally:
+            del self.waiting_on[current_task]
+
+    async def lookup(self, target_name: dns.name.Name,
+                     qtype: rdatatype,
+                     serve_stale: bool = True) -> dns.message.Message:
+        """
+        This function uses a recursive resolver to find the relevant answer to
+        the query. If the same lookup is already in progress its result is
+        shared
+        rather than resolving it again.
+        Parameters: target_name the hostname to get a DNS record for
+                    qtype the type of DNS record that is being looked for
+                    serve_stale whether an expired answer may be returned while
+                        it is refreshed in the background
+        """
+        key = (target_name.labels, qtype, serve_stale)
+        if key in self.inflight_lookups:
+            # Waiting on a lookup that depends on this one would never finish,
+            # so treat the loop like a route that doesn't resolve
+            if self.would_deadlock(key):
+                return dns.message.make_response(
+                    dns.message.make_query(target_name, qtype)
                 )
-                active_lookups.discard(target_name)
-                return res
+            return await self.wait_for_lookup(key)
 
-        # Load next server to query
-        server_entry = servers_to_query.pop()
-        server = server_entry[1]
+        future = asyncio.get_running_loop().create_future()
+        self.inflight_lookups[key] = (future, asyncio.current_task())
+        try:
+            response = await self.do_lookup(target_name, qtype, serve_stale)
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            # The error is raised from here as well, so mark it as retrieved to
+            # keep asyncio from reporting it again when nobody is waiting
+            future.exception()
+            raise
+        finally:
+            del self.inflight_lookups[key]
 
-        # If CNAME record being queried then we need to find its address
-        if server_entry[0] == rdatatype.CNAME:
-            server = resolve_dns_cname(server)
-            if server == "":
-                continue
+    async def lookup_types(self, target_name: dns.name.Name,
+                           qtypes: tuple) -> list:
+        """
+        Looks up several record types for one name and returns the responses in
+        the same order as qtypes. The lookups are run concurrently.
+        If an authority for the name is cached, the types are also asked for
+        in one multi-question query so their lookups can be answered from the
+        cache. That query is only waited for when the server is known to
+        support it, otherwise it is sent in the background to find out.
+        Parameters: target_name the hostname to get DNS records for
+                    qtypes the types of DNS record that are being looked for
+        """
+        labels = target_name.labels
+        uncached = [qtype for qtype in qtypes
+                    if self.get_cached_answer(labels, qtype) is None]
+        server = self.get_cached_authority_address(target_name)
+        lookups = [self.lookup(target_name, qtype) for qtype in qtypes]
+        if len(uncached) > 1 and server is not None:
+            supported = self.multi_question_support.get(server)
+            if supported:
+                await self.do_multi_question_query(target_name, uncached,
+                                                   server)
+            elif supported is None and server not in self.probe_tasks:
+                task = asyncio.create_task(
+                    self.do_multi_question_query(target_name, uncached,
+                                                 server)
+                )
+                self.probe_tasks[server] = task
+                task.add_done_callback(
+                    lambda _: self.probe_tasks.pop(server, None)
+                )
+        return list(await asyncio.gather(*lookups))
 
-        if server in queried_servers:
-            continue
-        queried_servers.append(server)
+    def get_cached_server_address(self, server: dns.name.Name):
+        """
+        Returns the cached address of a name server, "" if it is known not to
+        resolve, or None if it isn't cached. Stale addresses are refreshed in
+        the background.
+
+        server: the name of the server
+        """
+        cached = self.get_cached_answer(server.labels, rdatatype.A)
+        if cached is None:
+            cached = self.get_stale_answer(server.labels, rdatatype.A)
+            if cached is not None:
+                self.schedule_refresh(server, rdatatype.A)
+        if cached is None:
+            return None
+        return str(cached[0]) if len(cached) > 0 else ""
+
+    async def find_server_address(self, server: dns.name.Name, visited: set):
+        """
+        Returns the address of a name server if it is cached or being looked up
+        by another task, "" if it can't be resolved from here, or None if it
+        needs to be looked up
+
+        server: the name of the server
+        visited: the lookups already made by the current `do_lookup`
+        """
+        cached = self.get_cached_server_address(server)
+        if cached is not None:
+            return cached
+        # Don't query if looked up further up the stack
+        if (server.labels, rdatatype.A) in visited:
+            return ""
+        key = (server.labels, rdatatype.A, True)
+        if key in self.inflight_lookups and not self.would_deadlock(key):
+            response = await self.wait_for_lookup(key)
+            if len(response.answer) > 0:
+                return str(response.answer[0][0])
+            return ""
+        return None
+
+    async def do_lookup(self, target_name: dns.name.Name,
+                        qtype: rdatatype,
+                        serve_stale: bool) -> dns.message.Message:
+        """
+        Resolves a lookup by walking down from the closest cached authority,
+        see `lookup`.
+        Rather than recursing, aliases are followed in place and name servers
+        whose addresses are needed are looked up by pushing them onto a stack
+        of pending lookups. The lookup on top of the stack is the one worked
+        on.
+        """
+        pending = collections.deque([
+            PendingLookup(self, target_name, qtype, serve_stale)
+        ])
+        try:
+            return await self.walk_lookups(pending)
+        except asyncio.CancelledError:
+            for item in pending:
+                self.finish_inflight(item, None)
+            raise
+        except Exception as error:
+            for item in pending:
+                self.finish_inflight(item, error)
+            raise
+
+    def finish_inflight(self, item: PendingLookup, result) -> None:
+        """
+        Hands the result of a lookup pushed by `do_lookup` to the tasks
+        waiting on it and removes it from the in-flight lookups
+
+        item: The lookup that finished
+        result: The response, the exception it failed with, or None if it
+            was cancelled
+        """
+        if item.inflight_key is None:
+            return
+        future = self.inflight_lookups.pop(item.inflight_key)[0]
+        item.inflight_key = None
+        if isinstance(result, dns.message.Message):
+            future.set_result(result)
+        elif result is None:
+            future.cancel()
+        else:
+            future.set_exception(result)
+            # Retrieved here as there may be nobody waiting on it
+            future.exception()
 
-        do_dns_query(target_name, outbound_query, server, servers_to_query)
-        # End of loop
-    # Cache the fact that this route doesn't resolve to anything.
-    if target_name.labels not in answer_cache:
-        answer_cache[target_name.labels] = {}
-    answer_cache[target_name.labels][qtype] = []
-    return dns.message.make_response(outbound_query)
+    async def walk_lookups(self, pending: collections.deque):
+        """
+        Works through do_lookup's stack of pending lookups until the one at the
+        bottom is resolved and returns its response.
+        Name server lookups pushed onto the stack are registered as in-flight
+        lookups, so other tasks needing the same address wait for them instead
+        of looking it up again.
 
+        pending: The stack of pending lookups
+        """
+        visited = {(item.labels, item.qtype) for item in pending}
+        # The last reply received for the lookup on top of the stack
+        reply = None
 
-def print_results(results: dict) -> None:
+        while True:
+            item = pending[-1]
+            response = None
+            cname_rrset = None
+            if reply is not None:
+                # Use the reply just received rather than reading it back from
+                # the cache, answers with a short TTL may have expired already
+                answer = get_reply_answer(reply, item.target_name, item.qtype)
+                if answer is not None:
+                    response = dns.message.make_response(item.outbound_query)
+                    response.answer = [answer]
+                else:
+                    cname_rrset = get_reply_answer(reply, item.target_name,
+                                                   rdatatype.CNAME)
+                reply = None
+            # Check if an answer is cached
+            if response is None and cname_rrset is None:
+                response = item.cached_response()
+            if response is None:
+                if cname_rrset is None:
+                    cname_rrset = self.get_cached_answer(item.labels,
+                                                         rdatatype.CNAME)
+                if cname_rrset:
+                    alias = cname_rrset[0].target
+                    if (alias.labels, item.qtype) not in visited:
+                        visited.add((alias.labels, item.qtype))
+                        item.start(alias, item.qtype)
+                        continue
+                    # The alias loops back on itself
+                    response = dns.message.make_response(item.outbound_query)
+
+            if response is None:
+                level_start = item.level_start()
+                if len(item.servers) > 0:
+                    send = (len(item.servers) >= self.query_fanout
+                            or len(item.servers_to_query) <= level_start)
+                    if not send:
+                        # Send the servers already found rather than holding
+                        # them back while the address of a name server is
+                        # looked up
+                        server_type, server = item.servers_to_query[-1]
+                        send = (
+                            server_type == rdatatype.CNAME
+                            and self.get_cached_server_address(server) is None
+                        )
+                    if send:
+                        reply = await item.query_servers()
+                        continue
+                if len(item.servers_to_query) > level_start:
+                    # Load next server to query
+                    server_type, server = item.servers_to_query.pop()
+                    # If CNAME record being queried then we need to find its
+                    # address, looking it up first if need be
+                    if server_type == rdatatype.CNAME:
+                        server_name = server
+                        server = await self.find_server_address(server_name,
+                                                                visited)
+                        if server is None:
+                            visited.add((server_name.labels, rdatatype.A))
+                            child = PendingLookup(
+                                self, server_name, rdatatype.A, True,
+                                parent=item
+                            )
+                            key = (server_name.labels, rdatatype.A, True)
+                            if key not in self.inflight_lookups:
+                                self.inflight_lookups[key] = (
+                                    asyncio.get_running_loop().create_future(),
+                                    asyncio.current_task()
+                                )
+                                child.inflight_key = key
+                            pending.append(child)
+                            continue
+                    item.add_server(server)
+                    continue
+                if len(item.levels) > 0:
+                    # All of a zone's servers have been asked, go back to the
+                    # zone above
+                    item.levels.pop()
+                    continue
+                if len(item.cut_off) > 0:
+                    # The servers whose queries were cut off by another reply
+                    # are asked again before giving up
+                    for server in item.cut_off:
+                        item.queried_servers.remove(server)
+                        item.servers_to_query.append((rdatatype.A, server))
+                    item.cut_off = []
+                    continue
+                response = item.unresolved_response()
+
+            # The lookup on top of the stack is done
+            pending.pop()
+            self.finish_inflight(item, response)
+            if item.parent is None:
+                return response
+            if len(response.answer) > 0:
+                item.parent.add_server(str(response.answer[0][0]))
+
+
+# Resolver used by the module level lookup and collect_results
+default_resolver = Resolver()
+
+
+async def lookup(target_name: dns.name.Name,
+                 qtype: rdatatype) -> dns.message.Message:
     """
-    take the results of a `lookup` and print them to the screen like the host
-    program would.
+    Looks up a record with the default resolver, see `Resolver.lookup`
     """
+    return await default_resolver.lookup(target_name, qtype)
 
-    for rtype, fmt_str in FORMATS:
-        for result in results.get(rtype, []):
-            print(fmt_str.format(**result))
+
+async def collect_results(name: str) -> list:
+    """
+    Looks up the records for a name with the default resolver, see
+    `Resolver.collect_results`
+    """
+    return await default_resolver.collect_results(name)
+
+
+async def print_all_results(names: list,
+                            resolver: Resolver = default_resolver) -> None:
+    """
+    look up each name in turn and print its results, sharing one event loop
+    and one resolver (and therefore one set of caches) between all of them.
+    """
+    for a_domain_name in names:
+        responses = await resolver.collect_results(a_domain_name)
+        sys.stdout.writelines(iter_results(a_domain_name, responses))
 
 
 def main():
     """
-    if run from the command line, take args and call
-    printresults(lookup(hostname))
+    if run from the command line, take args and print the results of looking
+    up each hostname
     """
     argument_parser = argparse.ArgumentParser()
     argument_parser.add_argument("name", nargs="+",
@@ -255,9 +1227,13 @@ def main():
     argument_parser.add_argument("-v", "--verbose",
                                  help="increase output verbosity",
                                  action="store_true")
+    argument_parser.add_argument("-f", "--fanout", type=int,
+                                 default=QUERY_FANOUT,
+                                 help="number of servers to send each query "
+                                      "to at once")
     program_args = argument_parser.parse_args()
-    for a_domain_name in program_args.name:
-        print_results(collect_results(a_domain_name))
+    resolver = Resolver(query_fanout=max(1, program_args.fanout))
+    asyncio.run(print_all_results(program_args.name, resolver))
 
 
 if __name__ == "__main__":
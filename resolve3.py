@@ -3,7 +3,13 @@ resolve3.py: a recursive resolver built using dnspython
 """
 
 import argparse
+import asyncio
+import contextvars
+import os
+import sys
 
+import dns.asyncquery
+import dns.entropy
 import dns.message
 import dns.name
 import dns.query
@@ -11,10 +17,16 @@ import dns.rdata
 import dns.rdataclass
 import dns.rdatatype
 
-FORMATS = (("CNAME", "{alias} is an alias for {name}"),
-           ("A", "{name} has address {address}"),
-           ("AAAA", "{name} has IPv6 address {address}"),
-           ("MX", "{name} mail is handled by {preference} {exchange}"))
+# Bound format methods for each type of output line, called with the fields
+# as positional arguments so that no dict is built per record
+FORMATS = {"CNAME": "{0} is an alias for {1}\n".format,
+           "A": "{0} has address {1}\n".format,
+           "AAAA": "{0} has IPv6 address {1}\n".format,
+           "MX": "{0} mail is handled by {1} {2}\n".format}
+
+# Print the steps each lookup takes. Set RESOLVE_VERBOSE in the environment
+# or pass -v to turn it on; it stays off when running with -O.
+VERBOSE = __debug__ and bool(os.environ.get("RESOLVE_VERBOSE"))
 
 # current as of 19 October 2020
 ROOT_SERVERS = ("198.41.0.4",
@@ -32,90 +44,157 @@ ROOT_SERVERS = ("198.41.0.4",
                 "202.12.27.33")
 
 
-def collect_results(name: str) -> dict:
+async def collect_results(name: str) -> list:
     """
-    This function parses final answers into the proper data structure that
-    print_results requires. The main work is done within the `lookup` function.
+    This function looks up the CNAME, A, AAAA and MX records for a name and
+    returns the responses in that order, ready for iter_results. The main
+    work is done within the `lookup` function.
+    The four lookups are independent so they are run concurrently.
     """
-    full_response = {}
     target_name = dns.name.from_text(name)
-    # lookup CNAME
-    response = lookup(target_name, dns.rdatatype.CNAME)
-    cnames = []
-    for answers in response.answer:
+    return await asyncio.gather(lookup(target_name, dns.rdatatype.CNAME),
+                                lookup(target_name, dns.rdatatype.A),
+                                lookup(target_name, dns.rdatatype.AAAA),
+                                lookup(target_name, dns.rdatatype.MX))
+
+
+def iter_results(name: str, responses: list):
+    """
+    Yields the lines of output for the responses from collect_results, like
+    the host program would print them.
+    """
+    cname_response, a_response, aaaa_response, mx_response = responses
+    # CNAME
+    fmt = FORMATS["CNAME"]
+    for answers in cname_response.answer:
         for answer in answers:
-            cnames.append({"name": answer, "alias": name})
-    # lookup A
-    response = lookup(target_name, dns.rdatatype.A)
-    arecords = []
-    for answers in response.answer:
+            yield fmt(name, answer)
+    # A
+    fmt = FORMATS["A"]
+    for answers in a_response.answer:
+        if answers.rdtype != dns.rdatatype.A:
+            continue
         a_name = answers.name
         for answer in answers:
-            if answer.rdtype == 1:  # A record
-                arecords.append({"name": a_name, "address": str(answer)})
-    # lookup AAAA
-    response = lookup(target_name, dns.rdatatype.AAAA)
-    aaaarecords = []
-    for answers in response.answer:
+            yield fmt(a_name, answer)
+    # AAAA
+    fmt = FORMATS["AAAA"]
+    for answers in aaaa_response.answer:
+        if answers.rdtype != dns.rdatatype.AAAA:
+            continue
         aaaa_name = answers.name
         for answer in answers:
-            if answer.rdtype == 28:  # AAAA record
-                aaaarecords.append({"name": aaaa_name, "address": str(answer)})
-    # lookup MX
-    response = lookup(target_name, dns.rdatatype.MX)
-    mxrecords = []
-    for answers in response.answer:
+            yield fmt(aaaa_name, answer)
+    # MX
+    fmt = FORMATS["MX"]
+    for answers in mx_response.answer:
+        if answers.rdtype != dns.rdatatype.MX:
+            continue
         mx_name = answers.name
         for answer in answers:
-            if answer.rdtype == 15:  # MX record
-                mxrecords.append({"name": mx_name,
-                                  "preference": answer.preference,
-                                  "exchange": str(answer.exchange)})
-
-    full_response["CNAME"] = cnames
-    full_response["A"] = arecords
-    full_response["AAAA"] = aaaarecords
-    full_response["MX"] = mxrecords
-
-    return full_response
+            yield fmt(mx_name, answer.preference, answer.exchange)
 
 
 answer_cache = {}
 authority_cache = {}
-active_lookups = set()
+# Names being resolved further up the current call chain. Held in a
+# ContextVar so that each concurrently running lookup task sees only its own
+# chain rather than the lookups of its siblings.
+active_lookups = contextvars.ContextVar("active_lookups", default=frozenset())
+# Lookups currently being resolved, so that concurrent callers asking for the
+# same answer wait for it instead of repeating the queries.
+# (labels, rdtype) -> (future, owning task)
+inflight_lookups = {}
+# task -> key of the in-flight lookup that task is waiting on
+waiting_on = {}
+
+
+def would_deadlock(key: tuple) -> bool:
+    """
+    Checks whether waiting on the in-flight lookup for key would make the
+    current task wait on itself, either directly or through a chain of other
+    tasks waiting on each other's lookups
+    """
+    current_task = asyncio.current_task()
+    while key in inflight_lookups:
+        owner = inflight_lookups[key][1]
+        if owner is current_task:
+            return True
+        key = waiting_on.get(owner)
+    return False
 
 
-def lookup(target_name: dns.name.Name,
-           qtype: dns.rdatatype) -> dns.message.Message:
+async def lookup(target_name: dns.name.Name,
+                 qtype: dns.rdatatype) -> dns.message.Message:
     """
     This function uses a recursive resolver to find the relevant answer to the
-    query.
+    query. If the same lookup is already in progress its result is shared
+    rather than resolving it again.
     Parameters: target_name the hostname to get a DNS record for
                 qtype the type of DNS record that is being looked for
     """
+    key = (target_name.labels, qtype)
+    current_task = asyncio.current_task()
+    if key in inflight_lookups:
+        # Waiting on a lookup that depends on this one would never finish,
+        # so treat the loop like a route that doesn't resolve
+        if would_deadlock(key):
+            return dns.message.Message()
+        waiting_on[current_task] = key
+        try:
+            return await asyncio.shield(inflight_lookups[key][0])
+        finally:
+            del waiting_on[current_task]
+
+    future = asyncio.get_running_loop().create_future()
+    inflight_lookups[key] = (future, current_task)
+    try:
+        response = await do_lookup(target_name, qtype)
+        future.set_result(response)
+        return response
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as error:
+        future.set_exception(error)
+        # The error is raised from here as well, so mark it as retrieved to
+        # keep asyncio from reporting it again when nobody is waiting
+        future.exception()
+        raise
+    finally:
+        del inflight_lookups[key]
+
+
+async def do_lookup(target_name: dns.name.Name,
+                    qtype: dns.rdatatype) -> dns.message.Message:
+    """
+    Resolves a lookup by walking down from the closest cached authority,
+    see `lookup`
+    """
     # Resources:
     #   Message class for dnspython: https://dnspython.readthedocs.io/en/stable/message-class.html
     #   DNS Record info: https://www.iana.org/assignments/dns-parameters/dns-parameters.xhtml#dns-parameters-12
     #   DNS RFC: https://www.ietf.org/rfc/rfc1035.txt
     ''' use command 'dig +trace {{target_name}} +nodnssec' to see an example route to a target_name  '''
 
-    verbose = True
+    labels = target_name.labels
 
-    if verbose:
+    if VERBOSE:
         print("\n\n##################### Resolve ", dns.rdatatype.RdataType(qtype).name, " for: ", target_name, " ###################")
 
     # Check cache to check for target_name and return result if it does (if it's a CNAME then call lookup)
-    if target_name.labels in answer_cache.keys():
-        if qtype in answer_cache[target_name.labels].keys():  # If found exact match then return answer
-            if verbose:
+    cache_entry = answer_cache.get(labels)
+    if cache_entry is not None:
+        if qtype in cache_entry:  # If found exact match then return answer
+            if VERBOSE:
                 print("Found cached answer")
-            return answer_cache[target_name.labels][qtype]
-        elif dns.rdatatype.CNAME in answer_cache[target_name.labels].keys():
-            if len(answer_cache[target_name.labels][dns.rdatatype.CNAME].answer) > 0:
-                if verbose:
+            return cache_entry[qtype]
+        elif dns.rdatatype.CNAME in cache_entry:
+            if len(cache_entry[dns.rdatatype.CNAME].answer) > 0:
+                if VERBOSE:
                     print("Found cached alias")
                 # If CNAME cache then call unaliased lookup
-                return lookup((answer_cache[target_name.labels][dns.rdatatype.CNAME]).answer[0][0].target, qtype)
+                return await lookup((cache_entry[dns.rdatatype.CNAME]).answer[0][0].target, qtype)
 
     '''
     Initialize servers_to_query with root_servers
@@ -127,43 +206,45 @@ def lookup(target_name: dns.name.Name,
     # TODO authority map. look at whether it returns the string i can map it to. otherwise manually calculate authority hostname: #########################################
     # TODO: If the domain from the below for loop is in the answer cache then query that domain for the answer
 
-    for i in reversed(range(len(target_name.labels)-2)):
-        domain = target_name.labels[i+1:]
-        if domain in authority_cache.keys():
+    suffixes = [labels[i+1:] for i in reversed(range(len(labels)-2))]
+    for domain in suffixes:
+        if domain in authority_cache:
             if len(authority_cache[domain][dns.rdatatype.A]) > 0:
                 for server in authority_cache[domain][dns.rdatatype.A]:
                     servers_to_query.append((dns.rdatatype.A, server))
             # else:
             #     for server in authority_cache[domain][dns.rdatatype.CNAME]:
             #         servers_to_query.append((dns.rdatatype.CNAME, server))
-            if verbose:
+            if VERBOSE:
                 print("FOUND CACHED NAMESPACE AUTHORITY FOR ", str(domain))
-        if domain in answer_cache.keys():
-            if verbose:
+        if domain in answer_cache:
+            if VERBOSE:
                 print("FOUND CACHED NAMESPACE ANSWER FOR ", str(domain))
-            if dns.rdatatype.A in answer_cache[domain].keys():
-                servers_to_query.append((dns.rdatatype.A, answer_cache[domain][dns.rdatatype.A]))
-            # elif dns.rdatatype.CNAME in answer_cache[domain].keys():
+            if dns.rdatatype.A in answer_cache[domain]:
+                cached_a = answer_cache[domain][dns.rdatatype.A]
+                if len(cached_a.answer):
+                    servers_to_query.append((dns.rdatatype.A, str(cached_a.answer[0][0])))
+            # elif dns.rdatatype.CNAME in answer_cache[domain]:
             #     servers_to_query.append((dns.rdatatype.CNAME, answer_cache[domain][dns.rdatatype.CNAME]))
     if len(servers_to_query) == 0:
-        xdsafdsfds = ""
         for server in ROOT_SERVERS:
             servers_to_query.append((dns.rdatatype.A, server))
 
-    queried_servers = []
+    queried_servers = set()
+    outbound_query = dns.message.make_query(target_name, qtype)
 
     while len(servers_to_query):
         server_entry = servers_to_query.pop()
         server = server_entry[1]
 
         if server_entry[0] == dns.rdatatype.CNAME:
-            if target_name not in active_lookups and target_name.labels != server_entry[1].labels:
-                if verbose:
+            if target_name not in active_lookups.get() and labels != server_entry[1].labels:
+                if VERBOSE:
                     print("CALL TO ", target_name, " RESOLVING SERVER TO QUERY ", server, )
 
-                active_lookups.add(target_name)
-                server_ip = lookup(server, dns.rdatatype.A)
-                active_lookups.discard(target_name)
+                token = active_lookups.set(active_lookups.get() | {target_name})
+                server_ip = await lookup(server, dns.rdatatype.A)
+                active_lookups.reset(token)
                 if len(server_ip.answer):
                     server = str(server_ip.answer[0][0])
                 else:
@@ -173,44 +254,44 @@ def lookup(target_name: dns.name.Name,
 
         if server in queried_servers:
             continue
-        queried_servers.append(server)
+        queried_servers.add(server)
 
-        if verbose:
+        if VERBOSE:
             print("\nQuerying: ", server)
 
         try:
-            outbound_query = dns.message.make_query(target_name, qtype)
-            response = dns.query.udp(outbound_query, server, 3)
+            outbound_query.id = dns.entropy.random_16()
+            response = await dns.asyncquery.udp(outbound_query, server, 3)
         except Exception as e:
-            if verbose:
+            if VERBOSE:
                 print("Failed to reach server")
             continue
 
         if len(response.answer):
-            if verbose:
+            if VERBOSE:
                 print("Answer Found: ", response.answer)
 
-            if target_name.labels not in answer_cache.keys():
-                answer_cache[target_name.labels] = {}
-            answer_cache[target_name.labels][response.answer[0].rdtype] = response
+            if labels not in answer_cache:
+                answer_cache[labels] = {}
+            answer_cache[labels][response.answer[0].rdtype] = response
             if response.answer[0].rdtype == qtype:
                 return response
             elif response.answer[0].rdtype == dns.rdatatype.CNAME:
-                active_lookups.add(target_name)
-                res = lookup(response.answer[0][0].target, qtype)
-                active_lookups.discard(target_name)
+                token = active_lookups.set(active_lookups.get() | {target_name})
+                res = await lookup(response.answer[0][0].target, qtype)
+                active_lookups.reset(token)
                 return res
             else:
-                if verbose:
+                if VERBOSE:
                     print("Found answer but couldn't use it :(")
         elif len(response.authority): # Response gave no answers but did give authorities to look towards
-            if verbose:
+            if VERBOSE:
                 print("Authorities found: ", response.authority)
                 if len(response.additional):
                     print("ADDITIONAL FOUND: ", response.additional)
             for authority_list in response.authority:
                 if authority_list.rdtype == dns.rdatatype.NS:  # We only support NS authorities
-                    if authority_list.name not in authority_cache.keys():  # Any NS we come across should get an empty record created
+                    if authority_list.name.labels not in authority_cache:  # Any NS we come across should get an empty record created
                         authority_cache[authority_list.name.labels] = {dns.rdatatype.CNAME: [], dns.rdatatype.A: [], dns.rdatatype.AAAA: [], dns.rdatatype.MX: []}
                     for server_name in authority_list:
                         # Cache all authority CNAMEs even if there's no answer
@@ -220,7 +301,7 @@ def lookup(target_name: dns.name.Name,
                         foundMap = False
                         for server_RR in response.additional:
                             if server_RR.rdtype == dns.rdatatype.A:
-                                if server_name.target.labels not in authority_cache.keys():
+                                if server_name.target.labels not in authority_cache:
                                     authority_cache[server_name.target.labels] = {dns.rdatatype.CNAME: [], dns.rdatatype.A: [], dns.rdatatype.AAAA: [], dns.rdatatype.MX: []}
                                 if server_RR[0] not in authority_cache[server_name.target.labels][dns.rdatatype.A]:
                                     authority_cache[server_name.target.labels][dns.rdatatype.A].append(str(server_RR[0]))
@@ -229,42 +310,42 @@ def lookup(target_name: dns.name.Name,
                                     foundMap = True
                                     break
                         if not foundMap:
-                            if server_name.target.labels in authority_cache.keys():
+                            if server_name.target.labels in authority_cache:
                                 if dns.rdatatype.A in authority_cache[server_name.target.labels]:
                                     for server in authority_cache[server_name.target.labels][dns.rdatatype.A]:
                                         servers_to_query.append((dns.rdatatype.A, server, str(server_name)))
                             else:
                                 servers_to_query.append((dns.rdatatype.CNAME, server_name.target, str(server_name)))
         else:
-            if verbose:
+            if VERBOSE:
                 print("Query returned no results")
         # Just continue onto next server in servers_to_query
 
-    if verbose:
+    if VERBOSE:
         print("Ran out of servers to query")
     # Cache the fact that this route doesn't resolve to anything.
-    if target_name.labels not in answer_cache.keys():
-        answer_cache[target_name.labels] = {}
-    answer_cache[target_name.labels][qtype] = dns.message.Message()
+    if labels not in answer_cache:
+        answer_cache[labels] = {}
+    answer_cache[labels][qtype] = dns.message.Message()
     return dns.message.Message()
 
 
-def print_results(results: dict) -> None:
+async def print_all_results(names: list) -> None:
     """
-    take the results of a `lookup` and print them to the screen like the host
-    program would.
+    look up each name in turn and print its results, sharing one event loop
+    (and therefore one set of caches) between all of them.
     """
-
-    for rtype, fmt_str in FORMATS:
-        for result in results.get(rtype, []):
-            print(fmt_str.format(**result))
+    for a_domain_name in names:
+        responses = await collect_results(a_domain_name)
+        sys.stdout.writelines(iter_results(a_domain_name, responses))
 
 
 def main():
     """
-    if run from the command line, take args and call
-    printresults(lookup(hostname))
+    if run from the command line, take args and print the results of looking
+    up each hostname
     """
+    global VERBOSE
     argument_parser = argparse.ArgumentParser()
     argument_parser.add_argument("name", nargs="+",
                                  help="DNS name(s) to look up")
@@ -272,8 +353,9 @@ def main():
                                  help="increase output verbosity",
                                  action="store_true")
     program_args = argument_parser.parse_args()
-    for a_domain_name in program_args.name:
-        print_results(collect_results(a_domain_name))
+    if program_args.verbose:
+        VERBOSE = __debug__
+    asyncio.run(print_all_results(program_args.name))
 
 if __name__ == "__main__":
     main()
@@ -5,6 +5,7 @@
     # nativeBuildInputs is usually what you want -- tools you need to run
     nativeBuildInputs = with pkgs.buildPackages; [ 
 		python312Packages.dnspython
+		python312Packages.cachetools
 		jetbrains.pycharm-professional 
 	];
 }